@@ -8,11 +8,25 @@ import sys
 import os
 import json
 import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from multiprocessing import shared_memory
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
 import uvicorn
 
+# Serialize responses with orjson when available: it is a C implementation
+# several times faster than stdlib json and does not escape multi-byte
+# characters, which matters for large result strings and file listings.
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as DefaultResponse
+
 # Add OpenManus to path
 sys.path.insert(0, '/home/ubuntu/OpenManus')
 
@@ -25,72 +39,285 @@ except ImportError as e:
     print("Make sure OpenManus is installed and configured properly")
     sys.exit(1)
 
-app = FastAPI(title="OpenManus Bridge", version="1.0.0")
+app = FastAPI(title="OpenManus Bridge", version="1.0.0",
+              default_response_class=DefaultResponse)
 
 # Initialize OpenManus agent
 config = Config()
 agent = None
 
+WORKSPACE_PATH = "/home/ubuntu/OpenManus/workspace"
+
+# Cap concurrent agent runs. The ReAct loop keeps mutable scratchpad state, so
+# letting every request hit the shared agent at once risks corrupting it - and
+# even a reentrant agent would thrash the underlying LLM. Requests beyond the
+# cap queue on the semaphore; once the queue itself grows past
+# OPENMANUS_QUEUE_LIMIT we reject with 429 so callers back off instead of
+# piling up in memory. Both limits are per worker process: the host-wide cap
+# is BRIDGE_WORKERS x OPENMANUS_CONCURRENCY.
+AGENT_CONCURRENCY = int(os.environ.get("OPENMANUS_CONCURRENCY", "4"))
+AGENT_QUEUE_LIMIT = int(os.environ.get("OPENMANUS_QUEUE_LIMIT", "16"))
+AGENT_SEM = asyncio.Semaphore(AGENT_CONCURRENCY)
+_pending = 0  # requests currently holding or waiting for the semaphore
+_agent_lock = asyncio.Lock()
+
+
+async def _get_agent():
+    """Construct this worker's agent on first use (once per process)."""
+    global agent
+    if agent is None:
+        async with _agent_lock:
+            if agent is None:
+                try:
+                    agent = ReActAgent(config)
+                    _HEALTH["agent_ready"] = True
+                    print("OpenManus ReActAgent initialized successfully")
+                except Exception as e:
+                    print(f"Failed to initialize OpenManus agent: {e}")
+                    raise HTTPException(status_code=500, detail="Agent not initialized")
+    return agent
+
+
+async def _run_agent(task: str):
+    """Run the shared agent under the concurrency cap."""
+    global _pending
+    if _pending >= AGENT_CONCURRENCY + AGENT_QUEUE_LIMIT:
+        raise HTTPException(status_code=429, detail="Agent is busy, retry later")
+    _pending += 1
+    try:
+        async with AGENT_SEM:
+            return await (await _get_agent()).run(task)
+    finally:
+        _pending -= 1
+
+# Event-driven workspace watcher. Re-scanning the whole workspace after every
+# request is O(all files) of blocking stat calls on the event-loop thread; the
+# watcher instead records (timestamp, path) as files are created, and each
+# request reports the files created during its own start/end window. The
+# cache is read non-destructively, so concurrent requests cannot steal each
+# other's events (overlapping tasks may each see files from the shared
+# window, but every caller gets at least its own). watchdog is optional -
+# without it we fall back to a one-shot scandir in a worker thread.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+_observer = None
+_created_files: deque = deque(maxlen=1024)  # (monotonic timestamp, path)
+
+
+class _WorkspaceEventHandler(FileSystemEventHandler):
+    """Forward file-creation events from the watcher thread to the loop."""
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._loop.call_soon_threadsafe(
+                _created_files.append, (time.monotonic(), event.src_path))
+
+
+def _files_created_since(start: float) -> list:
+    """Metadata for files created after `start`, newest first, capped."""
+    files = []
+    for ts, path in reversed(_created_files):
+        if ts < start:
+            break  # entries are appended in order; everything older predates us
+        try:
+            files.append(_file_info(path))
+        except OSError:
+            continue  # file vanished between creation and stat
+        if len(files) >= MAX_FILES:
+            break
+    return files
+
+
+# Results larger than this many bytes are handed to the co-located Node.js
+# caller through a SharedMemory segment instead of the JSON body, skipping the
+# serialize -> TCP -> parse copies. Set SHM_THRESHOLD=0 to disable and always
+# send inline (e.g. when the caller is remote). Segments the caller never
+# unlinks are reaped after SHM_TTL seconds so they do not accumulate in
+# /dev/shm.
+SHM_THRESHOLD = int(os.environ.get("SHM_THRESHOLD", str(256 * 1024)))
+SHM_TTL = int(os.environ.get("SHM_TTL", "300"))
+
+# (reap deadline, segment name), in creation order. _share_result runs in
+# asyncio.to_thread pool threads, so all bookkeeping on the deque must hold
+# the lock - an unguarded check-then-popleft could reap an unexpired segment
+# out from under a caller, or raise on a concurrently emptied deque.
+_shm_pending: deque = deque()
+_shm_lock = threading.Lock()
+
+
+def _untrack_segment(shm):
+    """Detach a segment from the multiprocessing resource tracker.
+
+    On Python < 3.13 every SharedMemory(create=True) is registered with the
+    tracker, which unlinks it at process exit - yanking segments out from
+    under callers that have not read them yet and logging leak warnings.
+    Ownership is handed to the caller (or to _reap_stale_segments), so the
+    tracker must forget it.
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _reap_stale_segments():
+    """Unlink segments the caller never collected within SHM_TTL seconds."""
+    now = time.monotonic()
+    while True:
+        with _shm_lock:
+            if not _shm_pending or _shm_pending[0][0] > now:
+                break
+            _, name = _shm_pending.popleft()
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass  # caller already read and unlinked it
+        except Exception as e:
+            print(f"Failed to reap shared-memory segment {name}: {e}")
+
+
+def _share_result(data: bytes) -> str:
+    """Write result bytes to a SharedMemory segment; the caller should unlink
+    the segment after reading it, and stale segments are reaped after SHM_TTL."""
+    _reap_stale_segments()
+    name = f"notus-{uuid.uuid4().hex}"
+    try:
+        # track=False (3.13+) keeps the resource tracker out entirely
+        shm = shared_memory.SharedMemory(name=name, create=True, size=len(data), track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+        _untrack_segment(shm)
+    shm.buf[:len(data)] = data
+    shm.close()
+    with _shm_lock:
+        _shm_pending.append((time.monotonic() + SHM_TTL, name))
+    return name
+
+
+# Most files to report per response. Unbounded listings of a workspace with
+# thousands of accumulated outputs dominate serialization time and payload
+# size; callers only care about recent outputs.
+MAX_FILES = int(os.environ.get("WORKSPACE_MAX_FILES", "50"))
+
+
+def _file_info(path: str) -> dict:
+    """Metadata entry for one workspace file (no server-side absolute path)."""
+    st = os.stat(path)
+    return {"name": os.path.basename(path), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def _scan_workspace() -> list:
+    """Fallback scan; scandir avoids the extra stat that listdir+isfile pays."""
+    if not os.path.exists(WORKSPACE_PATH):
+        return []
+    entries = [entry for entry in os.scandir(WORKSPACE_PATH) if entry.is_file()]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [
+        {"name": entry.name, "size": entry.stat().st_size, "mtime": entry.stat().st_mtime}
+        for entry in entries[:MAX_FILES]
+    ]
+
 class TaskRequest(BaseModel):
     task: str
     task_type: Optional[str] = "general"
     context: Optional[Dict[str, Any]] = {}
 
+class FileInfo(BaseModel):
+    name: str
+    size: int
+    mtime: float
+
 class TaskResponse(BaseModel):
     success: bool
     result: Optional[str] = None
+    # Set instead of result for large outputs: the name and byte length of a
+    # SharedMemory segment the caller reads and then unlinks
+    result_shm: Optional[str] = None
+    result_len: Optional[int] = None
     error: Optional[str] = None
-    files: Optional[list] = []
+    files: list[FileInfo] = Field(default_factory=list)
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize OpenManus agent on startup"""
-    global agent
-    try:
-        agent = ReActAgent(config)
-        print("OpenManus ReActAgent initialized successfully")
-    except Exception as e:
-        print(f"Failed to initialize OpenManus agent: {e}")
-        raise
+    """Start the workspace watcher; the agent itself is built lazily per
+    worker in _get_agent so each uvicorn worker initializes exactly once."""
+    global _observer
+    if Observer is not None and os.path.exists(WORKSPACE_PATH):
+        _observer = Observer()
+        _observer.schedule(_WorkspaceEventHandler(asyncio.get_running_loop()), WORKSPACE_PATH)
+        _observer.daemon = True
+        _observer.start()
+        print(f"Watching workspace for new files: {WORKSPACE_PATH}")
+
+# Health payload built once and mutated in place when the agent comes up;
+# probes fire frequently enough that rebuilding the dict per call shows up
+_HEALTH = {
+    "status": "healthy",
+    "agent_ready": False
+}
+
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "agent_ready": agent is not None
-    }
+    return _HEALTH
 
-@app.post("/execute", response_model=TaskResponse)
+# exclude_none keeps null result/error fields out of the payload entirely,
+# trimming both JSON size and serialization work per response
+@app.post("/execute", response_model=TaskResponse, response_model_exclude_none=True)
 async def execute_task(request: TaskRequest):
     """
     Execute a task using OpenManus agent
     """
-    if agent is None:
-        raise HTTPException(status_code=500, detail="Agent not initialized")
-    
     try:
         # Execute task with OpenManus
-        result = await agent.run(request.task)
+        task_start = time.monotonic()
+        result = await _run_agent(request.task)
         
         # Extract result and files
         result_text = str(result) if result else "Task completed"
-        files = []
-        
-        # Check for generated files in workspace
-        workspace_path = "/home/ubuntu/OpenManus/workspace"
-        if os.path.exists(workspace_path):
-            for file in os.listdir(workspace_path):
-                file_path = os.path.join(workspace_path, file)
-                if os.path.isfile(file_path):
-                    files.append(file_path)
+
+        # Report files created during this request's window; without
+        # watchdog, fall back to a full scan off the event loop
+        if _observer is not None:
+            files = _files_created_since(task_start)
+        else:
+            files = await asyncio.to_thread(_scan_workspace)
         
+        # Hand large results over shared memory instead of the JSON body
+        result_shm = None
+        result_len = None
+        if SHM_THRESHOLD > 0:
+            data = result_text.encode()
+            if len(data) > SHM_THRESHOLD:
+                try:
+                    result_shm = await asyncio.to_thread(_share_result, data)
+                    result_len = len(data)
+                    result_text = None
+                except Exception as e:
+                    print(f"Shared-memory handoff failed, sending inline: {e}")
+
         return TaskResponse(
             success=True,
             result=result_text,
+            result_shm=result_shm,
+            result_len=result_len,
             files=files
         )
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         return TaskResponse(
             success=False,
@@ -102,18 +329,39 @@ async def chat(request: TaskRequest):
     """
     Chat with OpenManus agent (streaming not implemented yet)
     """
-    if agent is None:
-        raise HTTPException(status_code=500, detail="Agent not initialized")
-    
     try:
-        result = await agent.run(request.task)
+        result = await _run_agent(request.task)
         return {
             "success": True,
             "response": str(result)
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    # Run on port 8001 to avoid conflict with main app
-    uvicorn.run(app, host="0.0.0.0", port=8001, log_level="info")
+    # Run on port 8001 to avoid conflict with main app. uvloop and httptools
+    # replace the stdlib event loop and HTTP parser with C implementations
+    # when installed (like orjson/watchdog they are optional - "auto" keeps
+    # the stdlib implementations otherwise), and multiple workers scale the
+    # IO-bound bridge across cores - each worker process builds its own
+    # agent lazily, nothing is shared.
+    try:
+        import uvloop  # noqa: F401
+        import httptools  # noqa: F401
+        loop_impl, http_impl = "uvloop", "httptools"
+    except ImportError:
+        loop_impl, http_impl = "auto", "auto"
+    uvicorn.run(
+        "openmanus_bridge:app",
+        host="0.0.0.0",
+        port=8001,
+        loop=loop_impl,
+        http=http_impl,
+        workers=int(os.environ.get("BRIDGE_WORKERS", "4")),
+        # Per-request access logging formats a line (under the GIL) for every
+        # call even when output goes to a pipe; keep only warnings and errors
+        log_level="warning",
+        access_log=False,
+    )